@@ -228,6 +228,13 @@ class GenerationMixin:
             "`decoder_start_token_id` or `bos_token_id` has to be defined for encoder-decoder generation."
         )
 
+    def _get_bucket_sizes(self, per_bucket_size: int, bucket_num: int, max_length: int) -> List[int]:
+        """
+        Bucket sizes compiled before generation, covering every bucket size
+        `prepare_inputs_for_generation` can produce for inputs shorter than `max_length`.
+        """
+        return [(i + 1) * per_bucket_size for i in range(bucket_num)]
+
     @staticmethod
     def _expand_inputs_for_generation(
         expand_size: int = 1,
@@ -987,7 +994,7 @@ class GenerationMixin:
                     warnings.warn( "`max_length` not divided by `bucket_sizes", UserWarning,)
                     bucket_num = bucket_num + 1
                 per_bucket_size = max_length // bucket_num
-                bucket_sizes = [(i + 1) * (max_length // bucket_num) for i in range(bucket_num)]
+                bucket_sizes = self._get_bucket_sizes(per_bucket_size, bucket_num, max_length)
                 for i in bucket_sizes:
                     self.compile(*self.make_compile_tensor(i))
                 model_kwargs['bucket_size'] = per_bucket_size
@@ -46,6 +46,30 @@ WEIGHTS_INDEX_NAME = "mindspore.ckpt.index.json"
 HF_WEIGHTS_INDEX_NAME = "pytorch_model.bin.index.json"
 _init_weights = True
 
+
+def load_param_into_net(model: nn.Cell, param_dict: dict, prefix: str):
+    """
+    Load checkpoint params into the model, trying names with and without the base model prefix.
+    Returns the names of the checkpoint params that were not loaded.
+    """
+    not_loaded = list(param_dict.keys())
+    for _, param in model.parameters_and_names():
+        if param.name in param_dict:
+            param_name = param.name
+        else:
+            param_name = prefix + '.' + param.name
+        new_param = param_dict.get(param_name)
+        if new_param is not None:
+            param.set_dtype(new_param.dtype)
+            param.assign_value(new_param)
+            not_loaded.remove(param_name)
+
+    for param_name in model.load_extra_params(param_dict):
+        not_loaded.remove(param_name)
+
+    return not_loaded
+
+
 class PreTrainedModel(nn.Cell, CellUtilMixin, GenerationMixin):
     """
     Abstract class for Pretrained models
@@ -164,6 +188,14 @@ class PreTrainedModel(nn.Cell, CellUtilMixin, GenerationMixin):
             f"overwrite this method in the class {self.__class__}"
         )
 
+    def load_extra_params(self, param_dict):
+        """
+        Load checkpoint params whose layout differs from the model parameters, e.g. params
+        the model keeps stacked. Returns the names of the consumed checkpoint params.
+        """
+        # pylint: disable=unused-argument
+        return []
+
     def tie_weights(self):
         """
         Make sure we are sharing the input and output embeddings.
@@ -429,21 +461,6 @@ class PreTrainedModel(nn.Cell, CellUtilMixin, GenerationMixin):
                 ) from exc
             return state_dict
 
-        def load_param_into_net(model: nn.Cell, param_dict: dict, prefix: str):
-            not_loaded = list(param_dict.keys())
-            for _, param in model.parameters_and_names():
-                if param.name in param_dict:
-                    param_name = param.name
-                else:
-                    param_name = prefix + '.' + param.name
-                new_param = param_dict.get(param_name)
-                if new_param is not None:
-                    param.set_dtype(new_param.dtype)
-                    param.assign_value(new_param)
-                    not_loaded.remove(param_name)
-
-            return not_loaded
-
         if state_dict is None:
             if is_sharded:
                 not_loaded = []
@@ -18,9 +18,11 @@
 # pylint: disable=C0415
 # pylint: disable=C0209
 # pylint: disable=R1721
+# pylint: disable=W0212
 """ MindSpore ChatGLM model. """
 
 import copy
+import math
 import os
 import warnings
 import re
@@ -34,18 +36,42 @@ from mindspore import log as logger
 from mindspore import Parameter, Tensor
 from mindspore.common.initializer import initializer
 
+try:
+    from mindspore.ops import rotary_position_embedding
+except ImportError:
+    rotary_position_embedding = None
+
+try:
+    from mindspore.ops import flash_attention_score
+except ImportError:
+    flash_attention_score = None
+
+from mindnlp import ms_jit
 from mindnlp.abc import PreTrainedModel
 from mindnlp.generation.logits_process import LogitsProcessor, LogitsProcessorList
 from mindnlp.generation.stopping_criteria import StoppingCriteriaList
 from mindnlp.abc import GenerationConfig
 from mindnlp.configs import MINDNLP_MODEL_URL_BASE
-from mindnlp._legacy.functional import split, chunk, arange
+from mindnlp._legacy.functional import chunk
 from .chatglm_config import ChatGLMConfig
 
 PRETRAINED_MODEL_ARCHIVE_MAP = {
     'chatglm-6b': MINDNLP_MODEL_URL_BASE.format('glm', 'chatglm-6b')
 }
 
+# torch -> mindspore parameter renames
+LAYERNORM_WEIGHT_RE = re.compile(r'(layernorm.*)\.weight$')
+LAYERNORM_BIAS_RE = re.compile(r'(layernorm.*)\.bias$')
+EMBEDDING_RE = re.compile(r'(embeddings.*)\.weight$')
+# per layer layernorm params of a checkpoint, stored stacked in ChatGLMModel
+LAYER_LAYERNORM_RE = re.compile(r'layers\.(\d+)\.(input|post_attention)_layernorm\.(gamma|beta)$')
+# ascii punctuation next to a chinese character and its full width replacement, used by process_response
+PUNKT_PATTERNS = [
+    (re.compile(r"([\u4e00-\u9fff])%s" % re.escape(en)), r"\1%s" % zh,
+     re.compile(r"%s([\u4e00-\u9fff])" % re.escape(en)), r"%s\1" % zh)
+    for en, zh in [[",", "，"], ["!", "！"], [":", "："], [";", "；"], ["?", "？"]]
+]
+
 
 def torch_to_mindspore(pth_file, **kwargs):
     """convert torch checkpoint to mindspore"""
@@ -66,17 +92,19 @@ def torch_to_mindspore(pth_file, **kwargs):
 
     logger.info('Starting checkpoint conversion.')
     ms_ckpt = []
-    state_dict = torch.load(pth_file, map_location=torch.device('cpu'))
-
-    for key, value in state_dict.items():
-        if 'layernorm' in key:
-            if '.weight' in key:
-                key = key.replace('.weight', '.gamma')
-            if '.bias' in key:
-                key = key.replace('.bias', '.beta')
-        if 'embeddings' in key:
-            key = key.replace('weight', 'embedding_table')
-        ms_ckpt.append({'name': key, 'data': Tensor(value.numpy())})
+    try:
+        # map the file instead of reading it all into host memory
+        state_dict = torch.load(pth_file, map_location=torch.device('cpu'), mmap=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.1 or legacy (non zipfile) checkpoints
+        state_dict = torch.load(pth_file, map_location=torch.device('cpu'))
+
+    for key in list(state_dict.keys()):
+        value = state_dict.pop(key)
+        name = LAYERNORM_WEIGHT_RE.sub(r'\1.gamma', key)
+        name = LAYERNORM_BIAS_RE.sub(r'\1.beta', name)
+        name = EMBEDDING_RE.sub(r'\1.embedding_table', name)
+        ms_ckpt.append({'name': name, 'data': Tensor.from_numpy(value.numpy())})
 
     try:
         save_checkpoint(ms_ckpt, ms_ckpt_path)
@@ -86,18 +114,64 @@ def torch_to_mindspore(pth_file, **kwargs):
 
     return ms_ckpt_path
 
-class InvalidScoreLogitsProcessor(LogitsProcessor):
+# inputs smaller than this are scanned with numpy, the parallel numba kernel only pays off for large batches
+NUMBA_MIN_SCAN_SIZE = 1 << 16
+_numba_kernels = {}
+
+def _get_numba_find_mask_positions():
+    """numba kernel of `find_mask_positions`, compiled on first use, None when numba is not installed."""
+    if 'find_mask_positions' not in _numba_kernels:
+        try:
+            import numba
+        except ImportError:
+            _numba_kernels['find_mask_positions'] = None
+        else:
+            @numba.njit(parallel=True, cache=True)
+            def _find_mask_positions(input_ids, mask_token_id, gmask_token_id):
+                batch_size, seq_length = input_ids.shape
+                mask_positions = np.zeros(batch_size, np.int64)
+                use_gmasks = np.zeros(batch_size, np.bool_)
+                for i in numba.prange(batch_size):
+                    first_mask = -1
+                    for j in range(seq_length):
+                        if input_ids[i, j] == gmask_token_id:
+                            mask_positions[i] = j
+                            use_gmasks[i] = True
+                            break
+                        if input_ids[i, j] == mask_token_id and first_mask < 0:
+                            first_mask = j
+                    if not use_gmasks[i] and first_mask >= 0:
+                        mask_positions[i] = first_mask
+                return mask_positions, use_gmasks
+
+            _numba_kernels['find_mask_positions'] = _find_mask_positions
+    return _numba_kernels['find_mask_positions']
+
+def find_mask_positions(input_ids, mask_token_id, gmask_token_id):
+    """first gMASK of every sequence, or its first MASK when there is no gMASK, and whether it is a gMASK."""
+    if input_ids.size >= NUMBA_MIN_SCAN_SIZE:
+        kernel = _get_numba_find_mask_positions()
+        if kernel is not None:
+            return kernel(np.ascontiguousarray(input_ids), mask_token_id, gmask_token_id)
+    is_gmask = input_ids == gmask_token_id
+    use_gmasks = is_gmask.any(axis=1)
+    mask_positions = np.where(use_gmasks[:, None], is_gmask, input_ids == mask_token_id).argmax(axis=1)
+    return mask_positions, use_gmasks
+
+class InvalidScoreLogitsProcessor(nn.Cell, LogitsProcessor):
     """Invalid Score Processer."""
-    def __call__(self, input_ids: mindspore.Tensor, scores: mindspore.Tensor) -> mindspore.Tensor:
-        if ops.isnan(scores).any() or ops.isinf(scores).any():
-            scores = ops.zeros_like(scores)
-            scores[..., 5] = 5e4
-        return scores
-
-    def construct(self, ids):
-        """construct"""
-        output = ops.gather(self.embedding_table, ids, 0)
-        return output
+    def __call__(self, input_ids, scores):
+        # the generation mixin's searches hand over numpy scores, they get numpy scores back
+        if isinstance(scores, np.ndarray):
+            return super().__call__(None, Tensor(scores)).asnumpy()
+        return super().__call__(input_ids, scores)
+
+    def construct(self, input_ids, scores):  # pylint: disable=unused-argument
+        """replace the scores of rows holding nan/inf, without a host side check."""
+        invalid = ops.logical_or(ops.isnan(scores), ops.isinf(scores)).any(axis=-1, keep_dims=True)
+        # all probability on token 5 for the invalid rows
+        fallback = (ops.arange(scores.shape[-1]) == 5).astype(scores.dtype) * 5e4
+        return ops.select(ops.broadcast_to(invalid, scores.shape), ops.broadcast_to(fallback, scores.shape), scores)
 
 class PrefixEncoder(nn.Cell):
     """
@@ -136,10 +210,9 @@ class RotaryEmbedding(nn.Cell):
         t = np.arange(max_seq_len, dtype=inv_freq.dtype)
         freqs = np.outer(t, inv_freq)
         emb = np.concatenate((freqs, freqs), axis=-1)
-        self.cos_cached = np.expand_dims(np.cos(emb), 1)
-        self.sin_cached = np.expand_dims(np.sin(emb), 1)
-        self.cos_cached = Tensor(self.cos_cached, precision)
-        self.sin_cached = Tensor(self.sin_cached, precision)
+        # [max_seq_len, dim] constants in the compute precision, rebuilt at init and kept out of the checkpoint
+        self.cos_cached = Tensor(np.cos(emb), precision)
+        self.sin_cached = Tensor(np.sin(emb), precision)
 
     def construct(self):
         return self.cos_cached, self.sin_cached
@@ -149,21 +222,66 @@ def rotate_half(x):
     x1, x2 = chunk(x, 2, -1)
     return ops.concat((-x2, x1), axis=-1)
 
-def apply_rotary_pos_emb_index(q, k, cos, sin, position_id):
-    """apply rotary pos"""
-    # position_id: [sq, b], q, k: [sq, b, np, hn], cos: [sq, 1, hn] -> [sq, b, 1, hn]
-    cos = cos.squeeze(1)[position_id].expand_dims(2)
-    sin = sin.squeeze(1)[position_id].expand_dims(2)
+def gather_rotary_pos_emb(cos, sin, position_id):
+    """gather rotary cos/sin tables at the given positions."""
+    # position_id: [b, sq], cos: [max_seq_len, hn] -> [b, 1, sq, hn]
+    cos = ops.gather(cos, position_id, 0).expand_dims(1)
+    sin = ops.gather(sin, position_id, 0).expand_dims(1)
+    return cos, sin
+
+def apply_rotary_pos_emb_precomputed(q, k, cos, sin, fused=False):
+    """apply rotary pos with gathered cos/sin"""
+    # q, k: [b, np, sq, hn], cos, sin: [b, 1, sq, hn]
+    if fused:
+        q = rotary_position_embedding(q, cos, sin, mode=0)
+        k = rotary_position_embedding(k, cos, sin, mode=0)
+        return q, k
     q = (q * cos) + (rotate_half(q) * sin)
     k = (k * cos) + (rotate_half(k) * sin)
     return q, k
 
+def flash_attention_available():
+    """whether the fused flash attention kernel is registered (Ascend only)."""
+    return flash_attention_score is not None and mindspore.get_context('device_target') == 'Ascend'
+
+def init_kv_cache(config, num_layers, num_attention_heads, hidden_size_per_attention_head, params_dtype):
+    """[layers, 2, b, np, s, hn] kv cache Parameter, and its [..., 1] scales for the int8 cache (else None)."""
+    cache_shape = (num_layers, 2, getattr(config, 'max_batch_size', 1), num_attention_heads,
+                   config.max_sequence_length, hidden_size_per_attention_head)
+    cache_dtype = mindspore.int8 if config.kv_int8 else params_dtype
+    kv_cache = Parameter(initializer('zeros', cache_shape, cache_dtype), 'kv_cache', requires_grad=False)
+    kv_cache_scale = None
+    if config.kv_int8:
+        kv_cache_scale = Parameter(initializer('zeros', cache_shape[:-1] + (1,), params_dtype), 'kv_cache_scale',
+                                   requires_grad=False)
+    return kv_cache, kv_cache_scale
+
+def quantize_kv(x):
+    """symmetric int8 quantization of keys/values with one scale per token."""
+    # x: [..., sq, hn] -> int8 [..., sq, hn], scale: [..., sq, 1]
+    scale = ops.clamp(x.abs().max(axis=-1, keepdims=True) / 127.0, min=1e-5)
+    return ops.round(x / scale).astype(mindspore.int8), scale
+
+# q x k^T straight from the [b, np, sk, hn] cache slice, without materializing a transposed copy
+bmm_transpose_b = ops.BatchMatMul(transpose_b=True)
+
+@ms_jit
+def cached_attention(query_layer, key_layer, value_layer, attention_mask):
+    """attention over the cache bucket, shared by prefill ([b, np, sq, hn] queries) and decode (sq == 1)."""
+    # [b, np, sq, hn] x [b, np, sk, hn]^T --> [b, np, sq, sk]
+    attention_scores = bmm_transpose_b(query_layer, key_layer)
+    # the mask comes in as an additive bias, folded into the softmax input
+    attention_probs = ops.softmax(attention_scores + attention_mask, axis=-1)
+    # [b, np, sq, sk] x [b, np, sk, hn] --> [b, np, sq, hn]
+    context_layer = ops.bmm(attention_probs, value_layer)
+    return context_layer, attention_probs
+
 
 class SelfAttention(nn.Cell):
     """Self Attention."""
     def __init__(self, config, hidden_size, num_attention_heads,
                  layer_id, hidden_size_per_attention_head=None, bias=True,
-                 params_dtype=mindspore.float32, position_encoding_2d=True):
+                 params_dtype=mindspore.float32, position_encoding_2d=True, kv_cache=None, kv_cache_scale=None):
 
         super().__init__()
 
@@ -177,15 +295,12 @@ class SelfAttention(nn.Cell):
         self.output_attentions = config.output_attentions
         self.scaling_attention_score = True
         self.use_cache = config.use_cache
-
-        self.rotary_emb = RotaryEmbedding(
-            self.hidden_size // (self.num_attention_heads * 2)
-            if position_encoding_2d
-            else self.hidden_size // self.num_attention_heads,
-            base=10000,
-            precision=mindspore.float16,
-            max_seq_len=config.max_sequence_length
-        )
+        self.kv_int8 = config.kv_int8
+        # fused rotary and flash attention kernels are only registered for Ascend,
+        # flash attention never materializes the probs so it is skipped when they are requested
+        self.use_fused_rope = rotary_position_embedding is not None and \
+            mindspore.get_context('device_target') == 'Ascend'
+        self.use_flash_attention = flash_attention_available() and not self.output_attentions
 
         if hidden_size_per_attention_head is None:
             self.hidden_size_per_attention_head = hidden_size // num_attention_heads
@@ -193,6 +308,8 @@ class SelfAttention(nn.Cell):
             self.hidden_size_per_attention_head = hidden_size_per_attention_head
 
         self.inner_hidden_size = num_attention_heads * self.hidden_size_per_attention_head
+        # 1 / sqrt(hn), applied to the query before the score matmul
+        self.inv_scale = 1.0 / math.sqrt(self.hidden_size_per_attention_head)
 
         # Strided linear layer.
         self.query_key_value = nn.Dense(hidden_size, 3 * self.inner_hidden_size, has_bias=bias).to_float(params_dtype)
@@ -201,85 +318,78 @@ class SelfAttention(nn.Cell):
         max_batch_size = getattr(config, 'max_batch_size', 1)
         max_seq_len = config.max_sequence_length
 
-        self.cache_k = Parameter(initializer('zeros',
-                                (max_seq_len, max_batch_size, self.num_attention_heads, self.hidden_size_per_attention_head),
-                                params_dtype), 'cache_k', requires_grad=False)
-
-        self.cache_v = Parameter(initializer('zeros',
-                                (max_seq_len, max_batch_size, self.num_attention_heads, self.hidden_size_per_attention_head),
-                                params_dtype), 'cache_v', requires_grad=False)
-
-    @staticmethod
-    def attention_mask_func(attention_scores, attention_mask):
-        """attention mask function"""
-        return attention_scores.masked_fill(attention_mask, -10000.0)
-
-    def split_tensor_along_last_dim(self, tensor, num_partitions):
-        """Split a tensor along its last dimension.
-        Arguments:
-            tensor: input tensor.
-            num_partitions: number of partitions to split the tensor
-            contiguous_split_chunks: If True, make each chunk contiguous
-                                    in memory.
-        """
-        # Get the size and dimension.
-        last_dim = tensor.ndim - 1
-        last_dim_size = tensor.shape[last_dim] // num_partitions
-        # Split.
-        tensor_list = split(tensor, last_dim_size, axis=last_dim)
-
-        return tensor_list
+        # [layers, 2, b, np, s, hn] keys and values, shared by all layers of a ChatGLMModel, this layer
+        # owns `cache_layer`; a standalone layer allocates a single layer cache of its own
+        if kv_cache is None:
+            kv_cache, kv_cache_scale = init_kv_cache(config, 1, num_attention_heads,
+                                                     self.hidden_size_per_attention_head, params_dtype)
+            self.cache_layer = 0
+        else:
+            self.cache_layer = layer_id
+        self.kv_cache = kv_cache
+        if self.kv_int8:
+            # per token dequantization scales of the int8 cache, [layers, 2, b, np, s, 1]
+            self.kv_cache_scale = kv_cache_scale
+
+        # constant parts of the cache slot coordinates: [2, b, np, 1, 4] (layer, key/value, batch, head)
+        # tuples and slot positions
+        cache_indices = np.stack(np.meshgrid([self.cache_layer], np.arange(2), np.arange(max_batch_size),
+                                             np.arange(self.num_attention_heads), indexing='ij'), axis=-1)
+        self.cache_prefix_indices = Tensor(np.expand_dims(cache_indices[0], 3), mindspore.int64)
+        self.cache_positions = Tensor(np.arange(max_seq_len), mindspore.int64)
 
     def construct(
             self,
             hidden_states: mindspore.Tensor,
-            position_ids,
+            rotary_pos_emb,
             attention_mask: mindspore.Tensor,
-            layer_id,
             start_pos,
             bucket_size,
     ):
         """
-        hidden_states: [seq_len, batch, hidden_size]
-        attention_mask: [(1, 1), seq_len, seq_len]
+        hidden_states: [batch, seq_len, hidden_size]
+        rotary_pos_emb: gathered (cos, sin), followed by (block_cos, block_sin) for 2d position encoding
+        attention_mask: [(1, 1), seq_len, seq_len], bool for flash attention, additive bias otherwise
         """
 
-        # [seq_len, batch, 3 * hidden_size]
+        # [batch, seq_len, 3 * hidden_size]
         mixed_raw_layer = self.query_key_value(hidden_states)
-        # [seq_len, batch, 3 * hidden_size] --> [seq_len, batch, num_attention_heads, 3 * hidden_size_per_attention_head]
+        # [batch, seq_len, 3 * hidden_size] --> [batch, seq_len, num_attention_heads, 3, hidden_size_per_attention_head]
         new_tensor_shape = mixed_raw_layer.shape[:-1] + (
             self.num_attention_heads_per_partition,
-            3 * self.hidden_size_per_attention_head,
+            3,
+            self.hidden_size_per_attention_head,
         )
-        mixed_raw_layer = mixed_raw_layer.view(new_tensor_shape)
-        # [seq_len, batch, num_attention_heads, hidden_size_per_attention_head]
-        (query_layer, key_layer, value_layer) = self.split_tensor_along_last_dim(mixed_raw_layer, 3)
+        # --> [3, batch, num_attention_heads, seq_len, hidden_size_per_attention_head]
+        mixed_raw_layer = mixed_raw_layer.view(new_tensor_shape).transpose(3, 0, 2, 1, 4)
+        # [batch, num_attention_heads, seq_len, hidden_size_per_attention_head]
+        query_layer = mixed_raw_layer[0]
+        key_layer = mixed_raw_layer[1]
+        value_layer = mixed_raw_layer[2]
 
         if self.position_encoding_2d:
-            q1, q2 = chunk(query_layer, 2, axis=3)
-            k1, k2 = chunk(key_layer, 2, axis=3)
-            cos, sin = self.rotary_emb()
-            position_ids, block_position_ids = position_ids[:, 0, :].swapaxes(0, 1), \
-                position_ids[:, 1, :].swapaxes(0, 1)
+            half = self.hidden_size_per_attention_head // 2
+            q1, q2 = query_layer[..., :half], query_layer[..., half:]
+            k1, k2 = key_layer[..., :half], key_layer[..., half:]
+            cos, sin, block_cos, block_sin = rotary_pos_emb
 
-            q1, k1 = apply_rotary_pos_emb_index(q1, k1, cos, sin, position_ids)
-            q2, k2 = apply_rotary_pos_emb_index(q2, k2, cos, sin, block_position_ids)
+            q1, k1 = apply_rotary_pos_emb_precomputed(q1, k1, cos, sin, self.use_fused_rope)
+            q2, k2 = apply_rotary_pos_emb_precomputed(q2, k2, block_cos, block_sin, self.use_fused_rope)
 
             query_layer = ops.concat([q1, q2], axis=3)
             key_layer = ops.concat([k1, k2], axis=3)
         else:
-            position_ids = position_ids.swapaxes(0, 1)
-            cos, sin = self.rotary_emb()
-            # [seq_len, batch, num_attention_heads, hidden_size_per_attention_head]
-            query_layer, key_layer = apply_rotary_pos_emb_index(query_layer, key_layer, cos, sin, position_ids)
-        # [seq_len, batch, hidden_size]
+            cos, sin = rotary_pos_emb
+            # [batch, num_attention_heads, seq_len, hidden_size_per_attention_head]
+            query_layer, key_layer = apply_rotary_pos_emb_precomputed(query_layer, key_layer, cos, sin,
+                                                                      self.use_fused_rope)
+        # [batch, seq_len, hidden_size]
         context_layer, attention_probs = self.attention_fn(
             query_layer=query_layer,
             key_layer=key_layer,
             value_layer=value_layer,
             attention_mask=attention_mask,
             hidden_size_per_partition=self.hidden_size_per_partition,
-            layer_id=layer_id,
             start_pos=start_pos,
             bucket_size=bucket_size
         )
@@ -300,85 +410,22 @@ class SelfAttention(nn.Cell):
             value_layer,
             attention_mask,
             hidden_size_per_partition,
-            layer_id,
             start_pos,
             bucket_size
     ):
         """attention function."""
-        seq_len = query_layer.shape[0]
-
-        if seq_len > 1:
-            indices = arange(seq_len, dtype=mindspore.int64)
-            ops.assign(self.cache_k, ops.zeros_like(self.cache_k))
-            ops.assign(self.cache_v, ops.zeros_like(self.cache_v))
+        # prompt and single token steps are compiled separately, the branch is on a static shape
+        if query_layer.shape[2] > 1:
+            context_layer, attention_probs = self._attention_prefill(query_layer, key_layer, value_layer,
+                                                                     attention_mask, bucket_size)
         else:
-            indices = start_pos.expand_dims(0)
-        ops.scatter_update(self.cache_k, indices, key_layer)
-        ops.scatter_update(self.cache_v, indices, value_layer)
-
-        key_layer = self.cache_k[:bucket_size]
-        value_layer = self.cache_v[:bucket_size]
-
-        # seqlen, batch, num_attention_heads, hidden_size_per_attention_head
-        hidden_size = key_layer.shape[-1]
-
-        query_key_layer_scaling_coeff = ops.cast(layer_id + 1, query_layer.dtype)
+            context_layer, attention_probs = self._attention_decode(query_layer, key_layer, value_layer,
+                                                                    attention_mask, start_pos, bucket_size)
 
-        if self.scaling_attention_score:
-            query_layer = query_layer / (ops.sqrt(ops.cast(hidden_size, query_layer.dtype)) * query_key_layer_scaling_coeff)
-
-        # ===================================
-        # Raw attention scores. [b, np, s, s]
-        # ===================================
-
-        # [b, np, sq, sk]
-        output_size = (query_layer.shape[1], query_layer.shape[2], query_layer.shape[0], key_layer.shape[0])
-
-        # [sq, b, np, hn] -> [sq, b * np, hn]
-        query_layer = query_layer.view((output_size[2], output_size[0] * output_size[1], -1))
-        # [sk, b, np, hn] -> [sk, b * np, hn]
-        key_layer = key_layer.view((output_size[3], output_size[0] * output_size[1], -1))
-
-        matmul_result = ops.bmm(
-            query_layer.swapaxes(0, 1),  # [b * np, sq, hn]
-            key_layer.transpose(1, 2, 0)  # [b * np, hn, sk]
-        )
-
-        # change view to [b, np, sq, sk]
-        attention_scores = matmul_result.view(output_size)
-        attention_scores = attention_scores.masked_fill(attention_mask, -10000.0)
-        dtype = attention_scores.dtype
-        attention_scores = attention_scores * query_key_layer_scaling_coeff
-
-        attention_scores = attention_scores.astype(mindspore.float32)
-        attention_probs = ops.softmax(attention_scores, axis=-1)
-
-        attention_probs = attention_probs.astype(dtype)
-        # =========================
-        # Context layer. [sq, b, hp]
-        # =========================
-
-        # value_layer -> context layer.
-        # [sk, b, np, hn] --> [b, np, sq, hn]
-
-        # context layer shape: [b, np, sq, hn]
-        output_size = (value_layer.shape[1], value_layer.shape[2], query_layer.shape[0], value_layer.shape[3])
-
-        # change view [sk, b * np, hn]
-        value_layer = value_layer.view(value_layer.shape[0], output_size[0] * output_size[1], -1)
-
-        # change view [b * np, sq, sk]
-        attention_probs = attention_probs.view(output_size[0] * output_size[1], output_size[2], -1)
-
-        # matmul: [b * np, sq, hn]
-        context_layer = ops.bmm(attention_probs, value_layer.swapaxes(0, 1))
-        # change view [b, np, sq, hn]
-        context_layer = context_layer.view(output_size)
-
-        # [b, np, sq, hn] --> [sq, b, np, hn]
-        context_layer = context_layer.transpose(2, 0, 1, 3)
+        # [b, np, sq, hn] --> [b, sq, np, hn]
+        context_layer = context_layer.transpose(0, 2, 1, 3)
 
-        # [sq, b, np, hn] --> [sq, b, hp]
+        # [b, sq, np, hn] --> [b, sq, hp]
         new_context_layer_shape = context_layer.shape[:-2] + (hidden_size_per_partition,)
         context_layer = context_layer.view(new_context_layer_shape)
 
@@ -386,10 +433,91 @@ class SelfAttention(nn.Cell):
 
         return outputs
 
+    def _attention_prefill(self, query_layer, key_layer, value_layer, attention_mask, bucket_size):
+        """prompt step, fills cache slots [0, seq_len) and attends over the bucket."""
+        batch_size, _, seq_len, _ = query_layer.shape
+        # no need to clear the cache, slots past the written ones are masked out
+        indices = self._cache_indices(self.cache_positions[:seq_len], batch_size)
+        self.update_cache(key_layer, value_layer, indices)
+        if self.kv_int8:
+            # the prompt's own keys/values are used at full precision, only later steps read them back
+            # quantized, the rest of the bucket is masked out and needs no cache read
+            padding = ops.zeros((batch_size, self.num_attention_heads, bucket_size - seq_len,
+                                 self.hidden_size_per_attention_head), query_layer.dtype)
+            key_layer = ops.concat((key_layer, padding), axis=2)
+            value_layer = ops.concat((value_layer, padding), axis=2)
+        else:
+            key_layer, value_layer = self._read_cache(batch_size, bucket_size, query_layer.dtype)
+
+        # the per-layer coeff used to be divided out here and multiplied back after the mask,
+        # dropping it keeps the scores identical and lets mask and softmax work on them directly
+        if self.scaling_attention_score:
+            query_layer = query_layer * self.inv_scale
+
+        if self.use_flash_attention:
+            return self._flash_attention(query_layer, key_layer, value_layer, attention_mask)
+        return cached_attention(query_layer, key_layer, value_layer, attention_mask)
+
+    def _attention_decode(self, query_layer, key_layer, value_layer, attention_mask, start_pos, bucket_size):
+        """single token step, writes the cache slot at `start_pos` and attends over the bucket."""
+        batch_size = query_layer.shape[0]
+        # one slot per (key/value, batch, head), only the position column is filled in per step
+        indices = ops.concat((self.cache_prefix_indices[:, :batch_size],
+                              ops.broadcast_to(start_pos.reshape((1, 1, 1, 1, 1)),
+                                               (2, batch_size, self.num_attention_heads, 1, 1))), axis=-1)
+        self.update_cache(key_layer, value_layer, indices)
+        if self.kv_int8:
+            # past keys/values are dequantized, the current step's slot uses its full precision values
+            cached_key, cached_value = self._read_cache(batch_size, bucket_size, query_layer.dtype)
+            current = ops.broadcast_to((self.cache_positions[:bucket_size] == start_pos).reshape((1, 1, -1, 1)),
+                                       cached_key.shape)
+            key_layer = ops.select(current, ops.broadcast_to(key_layer, cached_key.shape), cached_key)
+            value_layer = ops.select(current, ops.broadcast_to(value_layer, cached_value.shape), cached_value)
+        else:
+            key_layer, value_layer = self._read_cache(batch_size, bucket_size, query_layer.dtype)
+
+        if self.scaling_attention_score:
+            query_layer = query_layer * self.inv_scale
+        if self.use_flash_attention:
+            # Flash-Decoding style, the single query row is split over tiles of the bucket
+            attention_mask = ops.broadcast_to(attention_mask, (batch_size, 1, 1, bucket_size))
+            return self._flash_attention(query_layer, key_layer, value_layer, attention_mask)
+        return cached_attention(query_layer, key_layer, value_layer, attention_mask)
+
+    def _flash_attention(self, query_layer, key_layer, value_layer, attention_mask):
+        """tiled kernel with online softmax over [b, np, s, hn] inputs, the query is already scaled."""
+        context_layer = flash_attention_score(query_layer, key_layer, value_layer, self.num_attention_heads,
+                                              attn_mask=attention_mask.astype(mindspore.uint8),
+                                              input_layout='BNSD')
+        return context_layer, None
+
+    def _read_cache(self, batch_size, bucket_size, dtype):
+        """[b, np, bucket_size, hn] keys and values, dequantized for the int8 cache."""
+        # only the live bucket is read and it is fed to the matmuls as is, no reshape or transpose
+        cache = self.kv_cache[self.cache_layer, :, :batch_size, :, :bucket_size]
+        if self.kv_int8:
+            cache = cache.astype(dtype) * self.kv_cache_scale[self.cache_layer, :, :batch_size, :, :bucket_size]
+        return cache[0], cache[1]
+
+    def update_cache(self, key_layer, value_layer, indices):
+        """write [b, np, s, hn] keys and values into the cache slots at `indices`, in one scatter."""
+        key_value = ops.stack((key_layer, value_layer))
+        if self.kv_int8:
+            key_value, key_value_scale = quantize_kv(key_value)
+            ops.scatter_nd_update(self.kv_cache_scale, indices, key_value_scale)
+        ops.scatter_nd_update(self.kv_cache, indices, key_value)
+
+    def _cache_indices(self, positions, batch_size):
+        """[2, b, np, len(positions), 5] coordinates of the key and value cache slots at `positions`."""
+        shape = (2, batch_size, self.num_attention_heads, positions.shape[0])
+        prefix_indices = ops.broadcast_to(self.cache_prefix_indices[:, :batch_size], shape + (4,))
+        return ops.concat((prefix_indices,
+                           ops.broadcast_to(positions.view(1, 1, 1, -1, 1), shape + (1,))), axis=-1)
+
 def gelu(x):
     """OpenAI's gelu implementation."""
-    return 0.5 * x * (1.0 + ops.tanh(0.7978845608028654 * x *
-                                       (1.0 + 0.044715 * x * x)))
+    # tanh approximation, done by a single fused kernel
+    return ops.gelu(x, approximate='tanh')
 
 class GEGLU(nn.Cell):
     """GEGLU"""
@@ -398,9 +526,8 @@ class GEGLU(nn.Cell):
         self.activation_fn = ops.gelu
 
     def construct(self, x):
-        # dim=-1 breaks in jit for pt<1.10
-        x1, x2 = chunk(x, 2, axis=(x.ndim - 1))
-        return x1 * self.activation_fn(x2)
+        half = x.shape[-1] // 2
+        return x[..., :half] * self.activation_fn(x[..., half:])
 
 
 class GLU(nn.Cell):
@@ -423,10 +550,10 @@ class GLU(nn.Cell):
 
     def construct(self, hidden_states):
         """
-        hidden_states: [seq_len, batch, hidden_size]
+        hidden_states: [batch, seq_len, hidden_size]
         """
 
-        # [seq_len, batch, inner_hidden_size]
+        # [batch, seq_len, inner_hidden_size]
         intermediate_parallel = self.dense_h_to_4h(hidden_states)
 
         intermediate_parallel = self.activation_func(intermediate_parallel)
@@ -451,14 +578,17 @@ class GLMBlock(nn.Cell):
             params_dtype=mindspore.float32,
             num_layers=28,
             position_encoding_2d=True,
+            kv_cache=None,
+            kv_cache_scale=None,
     ):
         super().__init__()
         # Set output layer initialization if not provided.
 
         self.layer_id = layer_id
 
-        # Layernorm on the input data.
-        self.input_layernorm = nn.LayerNorm([hidden_size], epsilon=layernorm_epsilon)
+        # Layernorms on the input data and after attention, the params live in the
+        # stacked buffers of ChatGLMModel (rows 2 * layer_id and 2 * layer_id + 1).
+        self.layer_norm = ops.LayerNorm(begin_norm_axis=-1, begin_params_axis=-1, epsilon=layernorm_epsilon)
 
         self.position_encoding_2d = position_encoding_2d
 
@@ -472,13 +602,15 @@ class GLMBlock(nn.Cell):
             bias=use_bias,
             params_dtype=params_dtype,
             position_encoding_2d=self.position_encoding_2d,
+            kv_cache=kv_cache,
+            kv_cache_scale=kv_cache_scale,
         )
 
         self.use_cache = config.use_cache
-        # Layernorm on the input data.
-        self.post_attention_layernorm = nn.LayerNorm([hidden_size], epsilon=layernorm_epsilon)
 
         self.num_layers = num_layers
+        # residual scale, fed to the fused multiply-add of both residual connections
+        self.alpha = Tensor((2 * num_layers) ** 0.5, params_dtype)
 
         # GLU
         self.mlp = GLU(
@@ -492,27 +624,29 @@ class GLMBlock(nn.Cell):
     def construct(
             self,
             hidden_states: mindspore.Tensor,
-            position_ids,
+            layernorm_gamma,
+            layernorm_beta,
+            rotary_pos_emb,
             attention_mask: mindspore.Tensor,
-            layer_id,
             start_pos,
             bucket_size
     ):
         """
-        hidden_states: [seq_len, batch, hidden_size]
+        hidden_states: [batch, seq_len, hidden_size]
+        layernorm_gamma, layernorm_beta: [2 * num_layers, hidden_size]
         attention_mask: [(1, 1), seq_len, seq_len]
         """
+        row = 2 * self.layer_id
 
         # Layer norm at the begining of the transformer layer.
-        # [seq_len, batch, hidden_size]
-        attention_input = self.input_layernorm(hidden_states)
+        # [batch, seq_len, hidden_size]
+        attention_input, _, _ = self.layer_norm(hidden_states, layernorm_gamma[row], layernorm_beta[row])
 
         # Self attention.
         attention_outputs = self.attention(
             attention_input,
-            position_ids,
+            rotary_pos_emb,
             attention_mask=attention_mask,
-            layer_id=layer_id,
             start_pos=start_pos,
             bucket_size=bucket_size
         )
@@ -523,16 +657,15 @@ class GLMBlock(nn.Cell):
         outputs = attention_outputs[1:]
 
         # Residual connection.
-        alpha = (2 * self.num_layers) ** 0.5
-        hidden_states = attention_input * alpha + attention_output
+        hidden_states = ops.addcmul(attention_output, attention_input, self.alpha)
 
-        mlp_input = self.post_attention_layernorm(hidden_states)
+        mlp_input, _, _ = self.layer_norm(hidden_states, layernorm_gamma[row + 1], layernorm_beta[row + 1])
 
         # MLP.
         mlp_output = self.mlp(mlp_input)
 
         # Second residual connection.
-        output = mlp_input * alpha + mlp_output
+        output = ops.addcmul(mlp_output, mlp_input, self.alpha)
 
         outputs = (output,) + outputs
 
@@ -556,16 +689,32 @@ class ChatGLMPreTrainedModel(PreTrainedModel):
     def _init_weights(self, cell: nn.Cell):
         """Initialize the weights."""
 
+    def load_extra_params(self, param_dict):
+        """copy the per layer layernorm params of a checkpoint into the stacked buffers."""
+        transformer = getattr(self, self.base_model_prefix, self)
+        buffers = {'gamma': transformer.layernorm_gamma, 'beta': transformer.layernorm_beta}
+        values = {key: buffer.asnumpy() for key, buffer in buffers.items()}
+        loaded = []
+        for name, param in param_dict.items():
+            match = LAYER_LAYERNORM_RE.search(name)
+            if match is None:
+                continue
+            row = 2 * int(match.group(1)) + (match.group(2) == 'post_attention')
+            values[match.group(3)][row] = param.asnumpy()
+            loaded.append(name)
+        if loaded:
+            for key, buffer in buffers.items():
+                buffer.set_data(Tensor(values[key], buffer.dtype))
+        return loaded
+
     def get_masks(self, input_ids):
         """get masks"""
-        batch_size, seq_length = input_ids.shape
-        context_lengths = [seq.tolist().index(self.config.bos_token_id) for seq in input_ids]
-        attention_mask = np.ones((batch_size, seq_length, seq_length))
-        attention_mask = np.tril(attention_mask)
-        for i, context_length in enumerate(context_lengths):
-            attention_mask[i, :, :context_length] = 1
-        attention_mask = np.expand_dims(attention_mask, 1)
-        attention_mask = (attention_mask < 0.5).astype(np.bool_)
+        _, seq_length = input_ids.shape
+        # index of the first bos token of every sequence
+        context_lengths = (input_ids == self.config.bos_token_id).argmax(-1)
+        attention_mask = np.tril(np.ones((seq_length, seq_length), dtype=np.bool_))
+        attention_mask = attention_mask | (np.arange(seq_length) < context_lengths[:, None, None])
+        attention_mask = np.expand_dims(~attention_mask, 1)
         return attention_mask
 
     def get_position_ids(self, input_ids, mask_positions, use_gmasks=None):
@@ -573,24 +722,17 @@ class ChatGLMPreTrainedModel(PreTrainedModel):
         batch_size, seq_length = input_ids.shape
         if use_gmasks is None:
             use_gmasks = [False] * batch_size
-        context_lengths = [seq.tolist().index(self.config.bos_token_id) for seq in input_ids]
+        context_lengths = (input_ids == self.config.bos_token_id).argmax(-1)
+        mask_positions = np.asarray(mask_positions, dtype=np.int64)
+        positions = np.arange(seq_length, dtype=np.int64)
+        after_context = positions >= context_lengths[:, None]
         if self.position_encoding_2d:
-            position_ids = np.tile(np.expand_dims(np.arange(seq_length, dtype=np.int64), 0),
-                                   (batch_size, 1))
-            for i, context_length in enumerate(context_lengths):
-                position_ids[i, context_length:] = mask_positions[i]
-            block_position_ids = [np.concatenate((
-                np.zeros(context_length, dtype=np.int64),
-                np.arange(seq_length - context_length, dtype=np.int64) + 1
-            )) for context_length in context_lengths]
-            block_position_ids = np.stack(block_position_ids, axis=0)
+            position_ids = np.where(after_context, mask_positions[:, None], positions)
+            block_position_ids = np.maximum(positions - context_lengths[:, None] + 1, 0)
             position_ids = np.stack((position_ids, block_position_ids), axis=1)
         else:
-            position_ids = np.tile(np.expand_dims(np.arange(seq_length, dtype=np.int64), 0),
-                                   (batch_size, 1))
-            for i, context_length in enumerate(context_lengths):
-                if not use_gmasks[i]:
-                    position_ids[i, context_length:] = mask_positions[i]
+            after_context &= ~np.asarray(use_gmasks, dtype=np.bool_)[:, None]
+            position_ids = np.where(after_context, mask_positions[:, None], positions)
 
         return position_ids
 
@@ -630,10 +772,15 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
         self.output_attentions = config.output_attentions
         self.output_hidden_states = config.output_hidden_states
         self.use_cache = config.use_cache
+        self.use_flash_attention = flash_attention_available() and not self.output_attentions
 
         self.word_embeddings = nn.Embedding(
             vocab_size=self.vocab_size, embedding_size=self.hidden_size).to_float(self.params_dtype)
 
+        # one kv cache for the whole stack, [layers, 2, b, np, s, hn], each layer writes its own row
+        self.kv_cache, self.kv_cache_scale = init_kv_cache(config, self.num_layers, self.num_attention_heads,
+                                                           self.hidden_size_per_attention_head, self.params_dtype)
+
         def get_layer(layer_id):
             return GLMBlock(
                 config,
@@ -646,16 +793,39 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
                 use_bias=True,
                 params_dtype=self.params_dtype,
                 position_encoding_2d=self.position_encoding_2d,
+                kv_cache=self.kv_cache,
+                kv_cache_scale=self.kv_cache_scale,
             )
 
         self.layers = nn.CellList(
             [get_layer(layer_id) for layer_id in range(self.num_layers)]
         )
+        # gamma/beta of the input and post attention layernorms of all layers, kept
+        # contiguous: rows 2 * i and 2 * i + 1 belong to layer i. Stored in the compute
+        # precision, so the blocks read them without a cast
+        layernorm_shape = (2 * self.num_layers, self.hidden_size)
+        self.layernorm_gamma = Parameter(initializer('ones', layernorm_shape, self.params_dtype), 'layernorm_gamma')
+        self.layernorm_beta = Parameter(initializer('zeros', layernorm_shape, self.params_dtype), 'layernorm_beta')
         # Final layer norm before output.
         self.final_layernorm = LayerNorm([self.hidden_size], epsilon=self.layernorm_epsilon)
 
+        # shared by all layers, positions are gathered once per step
+        self.rotary_emb = RotaryEmbedding(
+            self.hidden_size // (self.num_attention_heads * 2)
+            if self.position_encoding_2d
+            else self.hidden_size // self.num_attention_heads,
+            base=10000,
+            precision=mindspore.float16,
+            max_seq_len=self.max_sequence_length
+        )
+
+        # attention mask pieces sliced to the bucket size every step
+        self.bucket_positions = Tensor(np.arange(self.max_sequence_length), mindspore.int64)
+        self.bucket_tail_mask = Tensor(np.ones((1, 1, 1, self.max_sequence_length), np.bool_))
+
         if self.pre_seq_len is not None:
             self.prefix_tokens = Tensor(np.arange(self.pre_seq_len))
+            self.prefix_attention_mask = Tensor(np.zeros((1, 1, 1, self.pre_seq_len), np.bool_))
             self.prefix_encoder = PrefixEncoder(config)
             self.dropout = nn.Dropout(p=0.1)
 
@@ -665,6 +835,10 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
     def set_input_embeddings(self, new_embeddings: mindspore.Tensor):
         self.word_embeddings = new_embeddings
 
+    def get_past_key_values(self):
+        """the persistent [layers, 2, b, np, s, hn] kv cache filled by construct, `k, v = past[i]` per layer."""
+        return self.kv_cache
+
     def get_prompt(self, batch_size, dtype=mindspore.float16):
         """get prompt."""
         prefix_tokens = self.prefix_tokens.expand_dims(0).expand(batch_size, -1)
@@ -672,15 +846,14 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
         past_key_values = past_key_values.view(
             batch_size,
             self.pre_seq_len,
-            self.num_layers * 2,
+            self.num_layers,
+            2,
             self.num_attention_heads,
             self.hidden_size // self.num_attention_heads
         )
-        # seq_len, b, nh, hidden_size
         past_key_values = self.dropout(past_key_values)
-        past_key_values = past_key_values.permute([2, 1, 0, 3, 4]).split(2)
-        # past_key_values = [(v[0], v[1]) for v in past_key_values]
-        return past_key_values
+        # unpack per layer instead of permuting the whole prefix, [b, pre, np, hn] each
+        return [(past_key_values[:, :, i, 0], past_key_values[:, :, i, 1]) for i in range(self.num_layers)]
 
 
     def construct(
@@ -704,34 +877,47 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
 
         inputs_embeds = self.word_embeddings(input_ids)
 
+        seq_len = input_ids.shape[1]
         if self.pre_seq_len is not None and attention_mask is not None:
-            prefix_attention_mask = ops.ones((batch_size, 1, input_ids.shape[-1], self.pre_seq_len))
-            prefix_attention_mask = (prefix_attention_mask < 0.5).bool()
+            prefix_attention_mask = ops.broadcast_to(self.prefix_attention_mask,
+                                                     (batch_size, 1, seq_len, self.pre_seq_len))
             attention_mask = ops.concat((prefix_attention_mask, attention_mask), axis=3)
 
-        seq_len = input_ids.shape[1]
         if seq_len > 1:
-            attention_mask = ops.concat(
-                [attention_mask, ops.ones((1, 1, seq_len, bucket_size - seq_len)).astype(mindspore.bool_)],
-                axis=-1)
+            tail_mask = ops.broadcast_to(self.bucket_tail_mask[..., :bucket_size - seq_len],
+                                         (attention_mask.shape[0], 1, seq_len, bucket_size - seq_len))
+            attention_mask = ops.concat([attention_mask, tail_mask], axis=-1)
+        else:
+            # the new token is written at `start_pos`, later slots may hold stale keys
+            attention_mask = (self.bucket_positions[:bucket_size] > start_pos).reshape((1, 1, 1, -1))
+
+        if not self.use_flash_attention:
+            # built once per step and shared by all layers, flash attention takes the bool mask as is
+            attention_mask = attention_mask.astype(self.params_dtype) * -10000.0
+
+        cos, sin = self.rotary_emb()
+        if self.position_encoding_2d:
+            rotary_pos_emb = gather_rotary_pos_emb(cos, sin, position_ids[:, 0, :]) + \
+                gather_rotary_pos_emb(cos, sin, position_ids[:, 1, :])
         else:
-            attention_mask = (arange(bucket_size) > start_pos + seq_len).reshape((1, 1, 1, -1))
+            rotary_pos_emb = gather_rotary_pos_emb(cos, sin, position_ids)
 
-        # [seq_len, batch, hidden_size]
-        hidden_states = inputs_embeds.swapaxes(0, 1)
+        # [batch, seq_len, hidden_size], kept batch first so attention heads come out as BNSD
+        hidden_states = inputs_embeds
 
         all_self_attentions = ()
         all_hidden_states = ()
 
-        for i, layer in enumerate(self.layers):
+        for layer in self.layers:
             if self.output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
             layer_ret = layer(
                 hidden_states,
-                position_ids=position_ids,
+                layernorm_gamma=self.layernorm_gamma,
+                layernorm_beta=self.layernorm_beta,
+                rotary_pos_emb=rotary_pos_emb,
                 attention_mask=attention_mask,
-                layer_id=i,
                 start_pos=start_pos,
                 bucket_size=bucket_size
             )
@@ -747,6 +933,50 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
 
         return (hidden_states, all_hidden_states, all_self_attentions)
 
+def top_k_top_p_filter(scores, top_k, top_p):
+    """mask the [b, vocab] scores outside the top-k and the top-p nucleus with -inf."""
+    vocab_size = scores.shape[-1]
+    sorted_scores, _ = ops.sort(scores, axis=-1)
+    if 0 < top_k < vocab_size:
+        # keep the top_k largest, they sit at the end of the ascending sort
+        sorted_scores = ops.concat((ops.full_like(sorted_scores[..., :vocab_size - top_k], float('-inf')),
+                                    sorted_scores[..., vocab_size - top_k:]), axis=-1)
+    # drop the least likely tokens while their cumulative probability stays within 1 - top_p. The most likely
+    # token is always kept, so top_p <= 0 degrades to greedy instead of indexing past the vocab
+    cumulative_probs = ops.cumsum(ops.softmax(sorted_scores, axis=-1), axis=-1)
+    num_removed = (cumulative_probs <= 1 - top_p).astype(mindspore.int32).sum(axis=-1, keepdims=True)
+    num_removed = ops.minimum(num_removed, vocab_size - 1)
+    threshold = ops.gather_elements(sorted_scores, 1, num_removed)
+    return ops.masked_fill(scores, scores < threshold, float('-inf'))
+
+@ms_jit
+def sample_next_tokens(scores, temperature, top_k, top_p):
+    """temperature, top-k and top-p filtering followed by multinomial sampling, [b, vocab] -> [b]."""
+    scores = scores.astype(mindspore.float32) / temperature
+    scores = top_k_top_p_filter(scores, top_k, top_p)
+    return ops.multinomial(ops.softmax(scores, axis=-1), 1).squeeze(1)
+
+@ms_jit
+def greedy_next_tokens(scores):
+    """most likely next tokens, [b, vocab] -> [b]."""
+    return ops.argmax(scores, dim=-1)
+
+@ms_jit
+def update_unfinished(unfinished_sequences, next_tokens, eos_token_ids):
+    """clear the sequences whose next token is one of the [1, K] eos ids, compiled into one graph."""
+    is_eos = ops.equal(next_tokens.astype(eos_token_ids.dtype).expand_dims(1), eos_token_ids).any(axis=-1)
+    return unfinished_sequences * ops.logical_not(is_eos).astype(unfinished_sequences.dtype)
+
+@ms_jit
+def shifted_cross_entropy(lm_logits, labels):
+    """next token cross entropy, shift, flatten and float32 loss compiled into one graph."""
+    # Shift so that tokens < n predict n
+    shift_logits = lm_logits[..., :-1, :].astype(mindspore.float32)
+    shift_labels = labels[..., 1:]
+    # Flatten the tokens
+    return ops.cross_entropy(shift_logits.view(-1, shift_logits.shape[-1]), shift_labels.view(-1),
+                             ignore_index=-100)
+
 
 class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
     """ChatGLMForConditionalGeneration"""
@@ -765,6 +995,17 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
         self.config = config
 
         self.quantized = False
+        # token ids of the finished chat rounds, round index -> (tokenizer, round text, ids)
+        self._history_tok_cache = {}
+        # constant generation inputs, built once instead of every step
+        self.empty_attention_mask = Tensor(np.zeros((1, 1, 1, 1), np.bool_))
+        self.zero_start_pos = Tensor(0)
+        self._eos_token_ids_cache = {}
+        # shared, never mutated processor lists of chat/stream_chat and stream_generate, kept in a dict so the
+        # cell does not register the lists as sub cells
+        self._invalid_score_processor = InvalidScoreLogitsProcessor()
+        self._logits_processors = {'default': LogitsProcessorList([self._invalid_score_processor]),
+                                   'empty': LogitsProcessorList()}
 
         if self.config.quantization_bit:
             self.quantize(self.config.quantization_bit, empty_init=True)
@@ -783,29 +1024,35 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
         is_encoder_decoder: bool = False,
         standardize_cache_format: bool = False,
     ) -> Dict[str, Any]:
-        # update past_key_values
+        # update past_key_values, the cache lives in the attention layers and is only referenced here
         model_kwargs["start_pos"] = start_pos
+        model_kwargs["past_key_values"] = self.transformer.get_past_key_values()
 
-        # update attention mask
+        # update attention mask, decode steps are masked by their cache position inside the model, so the
+        # prompt mask is swapped for the cached constant instead of being grown every step
         if "attention_mask" in model_kwargs:
-            attention_mask = model_kwargs["attention_mask"]
-            if attention_mask is not None and attention_mask.dtype == mindspore.bool_:
-                attention_mask = ops.concat(
-                    [attention_mask, attention_mask.new_ones((*attention_mask.shape[:3], 1))], axis=3)
-                new_attention_mask = attention_mask[:, :, -1:].clone()
-                new_attention_mask[..., -1] = False
-                model_kwargs["attention_mask"] = ops.concat(
-                    [attention_mask, new_attention_mask], axis=2
-                )
+            model_kwargs["attention_mask"] = self.empty_attention_mask
 
-        # update position ids
+        # update position ids, written in place into a buffer allocated once for the max sequence length
         if "position_ids" in model_kwargs:
-            position_ids = model_kwargs["position_ids"]
-            new_position_id = position_ids[..., -1:]
-            new_position_id[:, 1, :] += 1
-            model_kwargs["position_ids"] = ops.concat(
-                [position_ids, new_position_id], axis=-1
-            )
+            position_ids_buffer = model_kwargs.get("position_ids_buffer")
+            if position_ids_buffer is None:
+                position_ids = model_kwargs["position_ids"]
+                if isinstance(position_ids, Tensor):
+                    position_ids = position_ids.asnumpy()
+                position_ids_buffer = np.zeros(position_ids.shape[:-1] + (self.max_sequence_length,), np.int64)
+                position_ids_buffer[..., :position_ids.shape[-1]] = position_ids
+                model_kwargs["position_ids_buffer"] = position_ids_buffer
+                model_kwargs["position_ids_len"] = position_ids.shape[-1]
+            cur_len = model_kwargs["position_ids_len"]
+            if self.position_encoding_2d:
+                # the position stays on the mask token, only the block position advances
+                position_ids_buffer[:, 0, cur_len] = position_ids_buffer[:, 0, cur_len - 1]
+                position_ids_buffer[:, 1, cur_len] = position_ids_buffer[:, 1, cur_len - 1] + 1
+            else:
+                position_ids_buffer[:, cur_len] = position_ids_buffer[:, cur_len - 1]
+            model_kwargs["position_ids_len"] = cur_len + 1
+            model_kwargs["position_ids"] = position_ids_buffer[..., :cur_len + 1]
 
         return model_kwargs
 
@@ -816,64 +1063,113 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             position_ids: Optional[np.ndarray] = None,
             start_pos: int = None,
             bucket_size: int = 512,
+            past_key_values: Optional[mindspore.Tensor] = None,
             **kwargs
     ) -> dict:
-        _, seq_length = input_ids.shape
-        MASK, gMASK = self.config.mask_token_id, self.config.gmask_token_id
-        seqs = input_ids.tolist()
-        mask_positions, use_gmasks = [], []
-        for seq in seqs:
-            mask_token = gMASK if gMASK in seq else MASK
-            use_gmask = mask_token == gMASK
-            mask_positions.append(seq.index(mask_token))
-            use_gmasks.append(use_gmask)
-
-        bucket_size = ((seq_length // bucket_size) + 1) * bucket_size
         # only last token for input_ids if past is not None
-        if start_pos is not None:
-            last_token = np.expand_dims(input_ids[:, -1], -1)
-            if attention_mask is not None and attention_mask.dtype == np.bool_:
-                attention_mask = attention_mask[:, :, -1:]
-            else:
-                attention_mask = np.zeros((1, 1, 1, 1)).astype(np.bool_)
-            if position_ids is not None:
-                position_ids = position_ids[..., -1:]
-            else:
-                context_lengths = [seq.index(self.config.bos_token_id) for seq in seqs]
-                if self.position_encoding_2d:
-                    position_ids = np.expand_dims(np.array(
-                        [[mask_position, seq_length - context_length] for mask_position, context_length in
-                         zip(mask_positions, context_lengths)], dtype=np.int64), -1)
-                else:
-                    position_ids = np.expand_dims(np.array(
-                        [mask_position for mask_position in mask_positions], dtype=np.int64), -1)
-
-            last_token = Tensor(last_token)
-            attention_mask = Tensor(attention_mask)
-            position_ids = Tensor(position_ids)
-            start_pos = Tensor(start_pos)
-            return (last_token, position_ids, attention_mask, start_pos, bucket_size)
+        if past_key_values is not None or start_pos is not None:
+            return self.prepare_inputs_decode(input_ids, attention_mask, position_ids, start_pos, bucket_size,
+                                              **kwargs)
+        return self.prepare_inputs_prefill(input_ids, attention_mask, position_ids, bucket_size, **kwargs)
+
+    def get_mask_positions(self, input_ids):
+        """first gMASK of every sequence, or its first MASK when there is no gMASK, and whether it is a gMASK."""
+        return find_mask_positions(input_ids, self.config.mask_token_id, self.config.gmask_token_id)
+
+    def prepare_inputs_prefill(  # pylint: disable=unused-argument
+            self,
+            input_ids: np.ndarray,
+            attention_mask: Optional[np.ndarray] = None,
+            position_ids: Optional[np.ndarray] = None,
+            bucket_size: int = 512,
+            mask_positions: Optional[np.ndarray] = None,
+            use_gmasks: Optional[np.ndarray] = None,
+            **kwargs
+    ):
+        """model inputs of the prompt step, `mask_positions`/`use_gmasks` are scanned for when not given."""
+        _, seq_length = input_ids.shape
+        bucket_size = self._get_bucket_size(seq_length, bucket_size)
 
         if attention_mask is not None and attention_mask.dtype != mindspore.bool_:
             attention_mask = None
         if attention_mask is None:
             attention_mask = self.get_masks(input_ids)
         if position_ids is None:
+            if mask_positions is None:
+                mask_positions, use_gmasks = self.get_mask_positions(input_ids)
             position_ids = self.get_position_ids(input_ids, mask_positions=mask_positions, use_gmasks=use_gmasks)
 
         input_ids = Tensor(input_ids)
         attention_mask = Tensor(attention_mask)
         position_ids = Tensor(position_ids)
-        start_pos = Tensor(0)
+        start_pos = self.zero_start_pos
 
         return (input_ids, position_ids, attention_mask, start_pos, bucket_size)
 
+    def prepare_inputs_decode(  # pylint: disable=unused-argument
+            self,
+            input_ids: np.ndarray,
+            attention_mask: Optional[np.ndarray] = None,
+            position_ids: Optional[np.ndarray] = None,
+            start_pos: int = None,
+            bucket_size: int = 512,
+            mask_positions: Optional[np.ndarray] = None,
+            context_lengths: Optional[np.ndarray] = None,
+            **kwargs
+    ):
+        """model inputs of a single token step, only the last token and its position are built."""
+        _, seq_length = input_ids.shape
+        bucket_size = self._get_bucket_size(seq_length, bucket_size)
+
+        last_token = np.expand_dims(input_ids[:, -1], -1)
+        # the single token mask is rebuilt from start_pos in the model, the input one is a placeholder
+        if not isinstance(attention_mask, Tensor):
+            attention_mask = self.empty_attention_mask
+        if position_ids is not None:
+            position_ids = position_ids[..., -1:]
+        else:
+            # the mask and bos positions are fixed by the prompt, callers can pass them in once scanned
+            if mask_positions is None:
+                mask_positions, _ = self.get_mask_positions(input_ids)
+            if self.position_encoding_2d:
+                if context_lengths is None:
+                    context_lengths = (input_ids == self.config.bos_token_id).argmax(axis=1)
+                position_ids = np.stack([mask_positions, seq_length - context_lengths], axis=1)[..., None]
+            else:
+                position_ids = mask_positions[:, None]
+            position_ids = position_ids.astype(np.int64)
+
+        last_token = Tensor(last_token)
+        position_ids = Tensor(position_ids)
+        start_pos = Tensor(start_pos)
+        return (last_token, position_ids, attention_mask, start_pos, bucket_size)
+
+    def _get_eos_token_ids(self, eos_token_id):
+        """[1, K] Tensor of the eos ids, cached per id list."""
+        key = tuple(eos_token_id)
+        if key not in self._eos_token_ids_cache:
+            self._eos_token_ids_cache[key] = Tensor(np.array([key], dtype=np.int64))
+        return self._eos_token_ids_cache[key]
+
+    def _get_bucket_size(self, seq_length, per_bucket_size):
+        """smallest bucket of the doubling ladder per_bucket_size * 2^n holding more than seq_length tokens."""
+        bucket_size = per_bucket_size << (seq_length // per_bucket_size).bit_length()
+        return min(bucket_size, self.max_sequence_length)
+
+    def _get_bucket_sizes(self, per_bucket_size, bucket_num, max_length):
+        # doubling ladder, one graph per size instead of one per multiple of per_bucket_size. It runs up to
+        # max_length, per_bucket_size * bucket_num falls short of it when max_length is not divisible
+        bucket_sizes = [per_bucket_size]
+        while bucket_sizes[-1] < max_length and bucket_sizes[-1] < self.max_sequence_length:
+            bucket_sizes.append(min(bucket_sizes[-1] * 2, self.max_sequence_length))
+        return bucket_sizes
+
     def make_compile_tensor(self, bucket_size):
         """make fake tensors for compile."""
         input_ids = Tensor(np.random.randint(0, self.config.vocab_size, (1, 1)))
-        attention_mask = Tensor(np.zeros((1, 1, 1, 1)).astype(np.bool_))
+        attention_mask = self.empty_attention_mask
         position_ids = Tensor(np.zeros((1, 2, 1)).astype(np.int64))
-        start_pos = Tensor(0)
+        start_pos = self.zero_start_pos
 
         return (input_ids, position_ids, attention_mask, start_pos, bucket_size)
 
@@ -896,29 +1192,18 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
 
         hidden_states = transformer_outputs[0]
 
-        lm_logits = self.lm_head(hidden_states).transpose(1, 0, 2)
+        lm_logits = self.lm_head(hidden_states)
         output = (lm_logits,) + transformer_outputs[1:]
 
         if labels is not None:
-            lm_logits = lm_logits.astype(mindspore.float32)
-
-            # Shift so that tokens < n predifct n
-            shift_logits = lm_logits[..., :-1, :]
-            shift_labels = labels[..., 1:]
-            # Flatten the tokens
-            loss = ops.cross_entropy(shift_logits.view(-1, shift_logits.shape[-1]), shift_labels.view(-1), ignore_index=-100)
-
-            lm_logits = lm_logits.astype(hidden_states.dtype)
-            loss = loss.astype(hidden_states.dtype)
+            loss = shifted_cross_entropy(lm_logits, labels).astype(hidden_states.dtype)
             return (loss,) + output
 
         return output
 
 
     @staticmethod
-    def _reorder_cache(
-            past: Tuple[Tuple[mindspore.Tensor, mindspore.Tensor], ...], beam_idx: mindspore.Tensor
-    ) -> Tuple[Tuple[mindspore.Tensor, mindspore.Tensor], ...]:
+    def _reorder_cache(past: mindspore.Tensor, beam_idx: mindspore.Tensor) -> mindspore.Tensor:
         """
         This function is used to re-order the `past_key_values` cache if [`~PreTrainedModel.beam_search`] or
         [`~PreTrainedModel.beam_sample`] is called. This is required to match `past_key_values` with the correct
@@ -926,48 +1211,66 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
 
         Output shares the same memory storage as `past`.
         """
-        return tuple(
-            (
-                layer_past[0].index_select(1, beam_idx),
-                layer_past[1].index_select(1, beam_idx),
-            )
-            for layer_past in past
-        )
+        # [layers, 2, b, np, s, hn], reordered along the batch axis by a single gather, cache rows past
+        # the beams keep their place
+        beam_idx = beam_idx.astype(mindspore.int64)
+        if beam_idx.shape[0] < past.shape[2]:
+            beam_idx = ops.concat((beam_idx, ops.arange(beam_idx.shape[0], past.shape[2], dtype=mindspore.int64)))
+        reordered = past.index_select(2, beam_idx)
+        if isinstance(past, Parameter):
+            # the cache is the attention layers' state, write the new order back in place
+            ops.assign(past, reordered)
+        return reordered
 
     def process_response(self, response):
         """process response."""
         response = response.strip()
         response = response.replace("[[训练时间]]", "2023年")
-        punkts = [
-            [",", "，"],
-            ["!", "！"],
-            [":", "："],
-            [";", "；"],
-            ["?", "？"],
-        ]
-        for item in punkts:
-            response = re.sub(r"([\u4e00-\u9fff])%s" % item[0], r"\1%s" % item[1], response)
-            response = re.sub(r"%s([\u4e00-\u9fff])" % item[0], r"%s\1" % item[1], response)
+        for before, before_repl, after, after_repl in PUNKT_PATTERNS:
+            response = before.sub(before_repl, response)
+            response = after.sub(after_repl, response)
         return response
 
+    def _get_chat_logits_processor(self, logits_processor):
+        """the caller's processors followed by the invalid score processor, without touching the caller's list."""
+        if not logits_processor:
+            return self._logits_processors['default']
+        return LogitsProcessorList([*logits_processor, self._invalid_score_processor])
+
+    def _build_chat_inputs(self, tokenizer, query, history):
+        """tokenize the chat prompt, reusing the token ids of unchanged history rounds."""
+        rounds = ["[Round {}]\n问：{}\n答：{}\n".format(i, old_query, response)
+                  for i, (old_query, response) in enumerate(history)]
+        prompt = "[Round {}]\n问：{}\n答：".format(len(history), query) if history else query
+        if tokenizer.remove_space:
+            # whitespace is collapsed across round boundaries, the rounds cannot be tokenized apart
+            input_ids = tokenizer._tokenizer.encode(tokenizer.preprocess_text("".join(rounds) + prompt))
+            return {"input_ids": Tensor(np.array([tokenizer.build_inputs_with_special_tokens(input_ids)], np.int64))}
+
+        for i in [i for i in self._history_tok_cache if i >= len(history)]:
+            del self._history_tok_cache[i]
+        input_ids = []
+        for i, round_text in enumerate(rounds):
+            cached = self._history_tok_cache.get(i)
+            # ids are only reused for the same tokenizer, another one may have a different vocab or preprocessing
+            if cached is None or cached[0] is not tokenizer or cached[1] != round_text:
+                # only the first round gets the dummy prefix, as in the joined prompt
+                round_ids = tokenizer._tokenizer.encode(tokenizer.preprocess_text(round_text), add_dummy_prefix=i == 0)
+                cached = (tokenizer, round_text, round_ids)
+                self._history_tok_cache[i] = cached
+            input_ids.extend(cached[2])
+        input_ids.extend(tokenizer._tokenizer.encode(tokenizer.preprocess_text(prompt), add_dummy_prefix=not history))
+        return {"input_ids": Tensor(np.array([tokenizer.build_inputs_with_special_tokens(input_ids)], np.int64))}
+
     def chat(self, tokenizer, query: str, history: List[Tuple[str, str]] = None, max_length: int = 2048, num_beams=1,
              do_sample=True, top_p=0.7, temperature=0.95, logits_processor=None, **kwargs):
         """chat."""
         if history is None:
             history = []
-        if logits_processor is None:
-            logits_processor = LogitsProcessorList()
-        logits_processor.append(InvalidScoreLogitsProcessor())
+        logits_processor = self._get_chat_logits_processor(logits_processor)
         gen_kwargs = {"max_length": max_length, "num_beams": num_beams, "do_sample": do_sample, "top_p": top_p,
                       "temperature": temperature, "logits_processor": logits_processor, **kwargs}
-        if not history:
-            prompt = query
-        else:
-            prompt = ""
-            for i, (old_query, response) in enumerate(history):
-                prompt += "[Round {}]\n问：{}\n答：{}\n".format(i, old_query, response)
-            prompt += "[Round {}]\n问：{}\n答：".format(len(history), query)
-        inputs = tokenizer([prompt], return_tensors="pt")
+        inputs = self._build_chat_inputs(tokenizer, query, history)
         outputs = self.generate(**inputs, **gen_kwargs)
         outputs = outputs.tolist()[0][len(inputs["input_ids"][0]):]
         response = tokenizer.decode(outputs)
@@ -980,22 +1283,18 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
         """stream chat"""
         if history is None:
             history = []
-        if logits_processor is None:
-            logits_processor = LogitsProcessorList()
-        logits_processor.append(InvalidScoreLogitsProcessor())
+        logits_processor = self._get_chat_logits_processor(logits_processor)
         gen_kwargs = {"max_length": max_length, "do_sample": do_sample, "top_p": top_p,
                       "temperature": temperature, "logits_processor": logits_processor, **kwargs}
-        if not history:
-            prompt = query
-        else:
-            prompt = ""
-            for i, (old_query, response) in enumerate(history):
-                prompt += "[Round {}]\n问：{}\n答：{}\n".format(i, old_query, response)
-            prompt += "[Round {}]\n问：{}\n答：".format(len(history), query)
-        inputs = tokenizer([prompt], return_tensors="pt")
+        inputs = self._build_chat_inputs(tokenizer, query, history)
+        # only the ids generated since the last yield are copied to the host
+        cursor = inputs["input_ids"].shape[-1]
+        response_ids = []
         for outputs in self.stream_generate(**inputs, **gen_kwargs):
-            outputs = outputs.tolist()[0][len(inputs["input_ids"][0]):]
-            response = tokenizer.decode(outputs)
+            response_ids.extend(outputs[0, cursor:].asnumpy().tolist())
+            cursor = outputs.shape[-1]
+            # decoded as a whole, pieces can merge across step boundaries
+            response = tokenizer.decode(response_ids)
             response = self.process_response(response)
             new_history = history + [(query, response)]
             yield response, new_history
@@ -1011,7 +1310,7 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
     ):
         """stream generate"""
         jit = kwargs.get('jit', True)
-        _, input_ids_seq_length = input_ids.shape[0], input_ids.shape[-1]
+        batch_size, input_ids_seq_length = input_ids.shape[0], input_ids.shape[-1]
 
         if generation_config is None:
             generation_config = self.generation_config
@@ -1050,7 +1349,7 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             )
 
         # 2. Set generation parameters if not already defined
-        logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
+        logits_processor = logits_processor if logits_processor is not None else self._logits_processors['empty']
         stopping_criteria = stopping_criteria if stopping_criteria is not None else StoppingCriteriaList()
 
         logits_processor = self._get_logits_processor(
@@ -1064,14 +1363,43 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
         stopping_criteria = self._get_stopping_criteria(
             generation_config=generation_config, stopping_criteria=stopping_criteria
         )
-        logits_warper = self._get_logits_warper(generation_config)
+        # InvalidScoreLogitsProcessor only looks at the scores, the ids are sliced only for processors that read them
+        needs_input_ids = any(not isinstance(processor, InvalidScoreLogitsProcessor) for processor in logits_processor)
+        # sampling, with temperature/top-k/top-p inside the same graph, or greedy, chosen once
+        if generation_config.do_sample:
+            temperature = generation_config.temperature if generation_config.temperature is not None else 1.0
+            top_k = generation_config.top_k if generation_config.top_k is not None else 0
+            top_p = generation_config.top_p if generation_config.top_p is not None else 1.0
+
+            def sampler(scores):
+                return sample_next_tokens(scores, temperature, top_k, top_p)
+        else:
+            sampler = greedy_next_tokens
 
-        unfinished_sequences = input_ids.new(input_ids.shape[0]).fill(1)
+        unfinished_sequences = ops.ones(batch_size, mindspore.int64)
+        # [1, K] eos ids, compared against all next tokens in one op
+        eos_token_ids = self._get_eos_token_ids(eos_token_id) if eos_token_id is not None else None
         scores = None
         first_step = True
 
+        # generated ids are written in place, `input_ids` is a view of the filled part. The host buffer feeds
+        # the model inputs, the device copy is what gets yielded, so callers keep receiving Tensors
+        if isinstance(input_ids, Tensor):
+            input_ids = input_ids.asnumpy()
+        input_ids_buffer = np.zeros((batch_size, max(generation_config.max_length, input_ids_seq_length + 1)),
+                                    input_ids.dtype)
+        input_ids_buffer[:, :input_ids_seq_length] = input_ids
+        device_ids_buffer = Tensor(input_ids_buffer)
+        cur_len = input_ids_seq_length
+
+        # mask and bos positions never change after the prompt, scan for them once
+        model_kwargs["mask_positions"], model_kwargs["use_gmasks"] = self.get_mask_positions(input_ids)
+        model_kwargs["context_lengths"] = (input_ids == self.config.bos_token_id).argmax(axis=1)
+        prepare_inputs = self.prepare_inputs_prefill
+
         while True:
-            model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
+            model_inputs = prepare_inputs(input_ids, **model_kwargs)
+            prepare_inputs = self.prepare_inputs_decode
             # forward pass to get next token
             if jit and not first_step:
                 outputs = self.compile_and_run(*model_inputs)
@@ -1079,31 +1407,38 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
                 outputs = self.construct(*model_inputs)
                 first_step = False
 
-            next_token_logits = outputs[0].asnumpy()[:, -1, :]
+            # logits stay on device, the only host copy per step is the sampled tokens
+            next_token_logits = outputs[0][:, -1, :]
 
-            # pre-process distribution
-            next_token_scores = logits_processor(input_ids, next_token_logits)
-            next_token_scores = logits_warper(input_ids, next_token_scores)
+            # pre-process distribution, the processors work on Tensors and read the ids from the device buffer
+            if logits_processor:
+                processor_input_ids = device_ids_buffer[:, :cur_len] if needs_input_ids else None
+                next_token_scores = logits_processor(processor_input_ids, next_token_logits)
+            else:
+                next_token_scores = next_token_logits
 
             # sample
-            probs = ops.softmax(next_token_scores, axis=-1)
-            if generation_config.do_sample:
-                next_tokens = ops.multinomial(probs, num_samples=1).squeeze(1)
-            else:
-                next_tokens = ops.argmax(probs, dim=-1)
+            next_tokens = sampler(next_token_scores)
+            if eos_token_ids is not None:
+                unfinished_sequences = update_unfinished(unfinished_sequences, next_tokens, eos_token_ids)
 
             # update generated ids, model inputs, and length for next step
-            input_ids = ops.concat([input_ids, next_tokens[:, None]], axis=-1)
-            start_pos = input_ids.shape[-1]
             model_kwargs = self._update_model_kwargs_for_generation(
-                outputs, start_pos, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
+                outputs, cur_len, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
-            unfinished_sequences = unfinished_sequences.mul((sum(next_tokens != i for i in eos_token_id)).long())
+            if cur_len == input_ids_buffer.shape[1]:
+                # a custom stopping criterion may run past max_length, grow both buffers
+                input_ids_buffer = np.concatenate([input_ids_buffer, np.zeros_like(input_ids_buffer)], axis=1)
+                device_ids_buffer = ops.concat([device_ids_buffer, ops.zeros_like(device_ids_buffer)], axis=1)
+            input_ids_buffer[:, cur_len] = next_tokens.asnumpy()
+            device_ids_buffer[:, cur_len] = next_tokens.astype(device_ids_buffer.dtype)
+            cur_len += 1
+            input_ids = input_ids_buffer[:, :cur_len]
 
             # stop when each sentence is finished, or if we exceed the maximum length
             if unfinished_sequences.max() == 0 or stopping_criteria(input_ids, scores):
                 break
-            yield input_ids
+            yield device_ids_buffer[:, :cur_len]
 
     def quantize(self, bits: int, empty_init=False, **kwargs):
         """TODO: support quantize"""
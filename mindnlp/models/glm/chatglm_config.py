@@ -53,6 +53,8 @@ class ChatGLMConfig(PreTrainedConfig):
             The epsilon used by the layer normalization layers.
         use_cache (`bool`, *optional*, defaults to `True`):
             Whether the model should return the last key/values attentions (not used by all models).
+        kv_int8 (`bool`, *optional*, defaults to `False`):
+            Whether to store the attention key/value cache as int8 with one scale per token.
         Example:
 
     ```python
@@ -91,6 +93,7 @@ class ChatGLMConfig(PreTrainedConfig):
             quantization_bit=0,
             pre_seq_len=None,
             prefix_projection=False,
+            kv_int8=False,
             **kwargs
     ):
         self.num_layers = num_layers
@@ -110,6 +113,7 @@ class ChatGLMConfig(PreTrainedConfig):
         self.quantization_bit = quantization_bit
         self.pre_seq_len = pre_seq_len
         self.prefix_projection = prefix_projection
+        self.kv_int8 = kv_int8
 
         super().__init__(
             pad_token_id=pad_token_id,
@@ -14,7 +14,9 @@
 # ============================================================================
 # pylint: disable=C0301
 # pylint: disable=W4902
+# pylint: disable=W0212
 """Test ChatGLM"""
+import importlib.util
 import random
 import unittest
 import pytest
@@ -23,7 +25,11 @@ import numpy as np
 import mindspore
 from mindspore import Tensor
 
-from mindnlp.models.glm.chatglm import ChatGLMForConditionalGeneration
+from mindnlp.models.glm.chatglm import ChatGLMForConditionalGeneration, InvalidScoreLogitsProcessor, \
+    top_k_top_p_filter, find_mask_positions, _get_numba_find_mask_positions
+from mindnlp.generation.logits_process import LogitsProcessorList
+from mindnlp.abc.models.pretrained_model import load_param_into_net
+from mindnlp.models.glm.chatglm_config import ChatGLMConfig
 from mindnlp.transforms.tokenizers import ChatGLMTokenizer
 
 def set_random_seed(seed):
@@ -58,6 +64,341 @@ def get_model_and_tokenizer():
     return model, tokenizer
 
 
+def get_tiny_config(**kwargs):
+    """get a ChatGLM config small enough for unit tests, special tokens at the end of the vocab"""
+    return ChatGLMConfig(vocab_size=1000, hidden_size=32, num_layers=2, num_attention_heads=4,
+                         inner_hidden_size=64, max_sequence_length=256, bos_token_id=994,
+                         eos_token_id=995, mask_token_id=990, gmask_token_id=991, **kwargs)
+
+
+def get_tiny_model(max_batch_size=1, **kwargs):
+    """get a randomly initialized ChatGLM small enough for unit tests"""
+    config = get_tiny_config(**kwargs)
+    config.max_batch_size = max_batch_size
+    model = ChatGLMForConditionalGeneration(config)
+    model.set_train(False)
+    return model
+
+
+def random_glm_inputs(batch_size, seq_length, config, gmask_rate=0.5):
+    """random prompts with a MASK or gMASK token before the bos token, at random context lengths"""
+    input_ids = np.random.randint(5, config.mask_token_id, (batch_size, seq_length)).astype(np.int64)
+    for seq in input_ids:
+        context_length = random.randint(1, seq_length - 1)
+        seq[context_length] = config.bos_token_id
+        mask_token_id = config.gmask_token_id if random.random() < gmask_rate else config.mask_token_id
+        seq[random.randint(0, context_length - 1)] = mask_token_id
+    return input_ids
+
+
+def loop_get_masks(input_ids, bos_token_id):
+    """per sequence attention mask, as computed before vectorization"""
+    batch_size, seq_length = input_ids.shape
+    context_lengths = [seq.tolist().index(bos_token_id) for seq in input_ids]
+    attention_mask = np.tril(np.ones((batch_size, seq_length, seq_length)))
+    for i, context_length in enumerate(context_lengths):
+        attention_mask[i, :, :context_length] = 1
+    attention_mask = np.expand_dims(attention_mask, 1)
+    return (attention_mask < 0.5).astype(np.bool_)
+
+
+def loop_get_position_ids(input_ids, mask_positions, use_gmasks, bos_token_id, position_encoding_2d):
+    """per sequence position ids, as computed before vectorization"""
+    batch_size, seq_length = input_ids.shape
+    context_lengths = [seq.tolist().index(bos_token_id) for seq in input_ids]
+    position_ids = np.tile(np.arange(seq_length, dtype=np.int64)[None], (batch_size, 1))
+    if position_encoding_2d:
+        for i, context_length in enumerate(context_lengths):
+            position_ids[i, context_length:] = mask_positions[i]
+        block_position_ids = np.stack([np.concatenate((
+            np.zeros(context_length, dtype=np.int64),
+            np.arange(seq_length - context_length, dtype=np.int64) + 1
+        )) for context_length in context_lengths], axis=0)
+        return np.stack((position_ids, block_position_ids), axis=1)
+    for i, context_length in enumerate(context_lengths):
+        if not use_gmasks[i]:
+            position_ids[i, context_length:] = mask_positions[i]
+    return position_ids
+
+
+class ChatGLMInputsTest(unittest.TestCase):
+    """ChatGLM attention mask and position ids test."""
+    def test_get_masks(self):
+        """vectorized masks must match the per sequence loop"""
+        set_random_seed(42)
+        model = get_tiny_model()
+        for batch_size, seq_length in [(1, 2), (3, 17), (8, 64)]:
+            input_ids = random_glm_inputs(batch_size, seq_length, model.config)
+            expected = loop_get_masks(input_ids, model.config.bos_token_id)
+            np.testing.assert_array_equal(expected, model.get_masks(input_ids))
+
+    def test_get_position_ids(self):
+        """vectorized position ids must match the per sequence loop, with and without 2d positions"""
+        set_random_seed(42)
+        for position_encoding_2d in [True, False]:
+            model = get_tiny_model(position_encoding_2d=position_encoding_2d)
+            for batch_size, seq_length in [(1, 2), (3, 17), (8, 64)]:
+                input_ids = random_glm_inputs(batch_size, seq_length, model.config)
+                use_gmasks = [model.config.gmask_token_id in seq for seq in input_ids.tolist()]
+                mask_positions = [seq.index(model.config.gmask_token_id if use_gmask else model.config.mask_token_id)
+                                  for seq, use_gmask in zip(input_ids.tolist(), use_gmasks)]
+                expected = loop_get_position_ids(input_ids, mask_positions, use_gmasks,
+                                                 model.config.bos_token_id, position_encoding_2d)
+                np.testing.assert_array_equal(expected, model.get_position_ids(input_ids, mask_positions, use_gmasks))
+
+
+def loop_find_mask_positions(input_ids, mask_token_id, gmask_token_id):
+    """per sequence mask scan, as computed before vectorization"""
+    mask_positions, use_gmasks = [], []
+    for seq in input_ids.tolist():
+        mask_token = gmask_token_id if gmask_token_id in seq else mask_token_id
+        mask_positions.append(seq.index(mask_token))
+        use_gmasks.append(mask_token == gmask_token_id)
+    return mask_positions, use_gmasks
+
+
+def random_mask_inputs(batch_size, seq_length, config, gmask_rate):
+    """random prompts, some holding both a MASK and a gMASK and some several of them"""
+    input_ids = random_glm_inputs(batch_size, seq_length, config, gmask_rate)
+    for seq in input_ids:
+        if random.random() < 0.3:
+            seq[random.randint(0, seq_length - 1)] = random.choice([config.mask_token_id, config.gmask_token_id])
+    return input_ids
+
+
+class ChatGLMMaskPositionsTest(unittest.TestCase):
+    """ChatGLM mask position scan test."""
+    config = get_tiny_config()
+
+    def check_find_mask_positions(self, find_fn, batch_size, seq_length):
+        """compare a scan against the per sequence loop for MASK only, gMASK only and mixed batches"""
+        for gmask_rate in [0.0, 1.0, 0.5]:
+            input_ids = random_mask_inputs(batch_size, seq_length, self.config, gmask_rate)
+            expected_positions, expected_use_gmasks = loop_find_mask_positions(
+                input_ids, self.config.mask_token_id, self.config.gmask_token_id)
+            mask_positions, use_gmasks = find_fn(input_ids, self.config.mask_token_id, self.config.gmask_token_id)
+            self.assertListEqual(expected_positions, np.asarray(mask_positions).tolist())
+            self.assertListEqual(expected_use_gmasks, np.asarray(use_gmasks).tolist())
+
+    def test_find_mask_positions(self):
+        """numpy scan must match the per sequence loop"""
+        set_random_seed(42)
+        for batch_size, seq_length in [(1, 2), (4, 33), (16, 128)]:
+            self.check_find_mask_positions(find_mask_positions, batch_size, seq_length)
+
+    @pytest.mark.skipif(importlib.util.find_spec("numba") is None, reason="numba is not installed")
+    def test_find_mask_positions_numba(self):
+        """numba kernel must match the per sequence loop"""
+        set_random_seed(42)
+        kernel = _get_numba_find_mask_positions()
+        for batch_size, seq_length in [(1, 2), (4, 33), (64, 1024)]:
+            self.check_find_mask_positions(kernel, batch_size, seq_length)
+
+
+class ChatGLMBucketTest(unittest.TestCase):
+    """ChatGLM bucket ladder test."""
+    def test_bucket_sizes_cover_prepare_inputs(self):
+        """every bucket prepare_inputs can pick below max_length must be precompiled"""
+        model = get_tiny_model()
+        for max_length in range(2, model.max_sequence_length + 1):
+            for bucket_num in range(1, 9):
+                # same split as the bucketed greedy search
+                if max_length % bucket_num != 0:
+                    bucket_num = bucket_num + 1
+                per_bucket_size = max_length // bucket_num
+                if per_bucket_size == 0:
+                    continue
+                bucket_sizes = model._get_bucket_sizes(per_bucket_size, bucket_num, max_length)
+                for seq_length in range(1, max_length):
+                    self.assertIn(model._get_bucket_size(seq_length, per_bucket_size), bucket_sizes,
+                                  f"max_length={max_length}, bucket_num={bucket_num}, seq_length={seq_length}")
+
+
+def join_chat_prompt(query, history):
+    """chat prompt as a single string"""
+    if not history:
+        return query
+    prompt = ""
+    for i, (old_query, response) in enumerate(history):
+        prompt += f"[Round {i}]\n问：{old_query}\n答：{response}\n"
+    return prompt + f"[Round {len(history)}]\n问：{query}\n答："
+
+
+class ChatGLMChatInputsTest(unittest.TestCase):
+    """ChatGLM chat prompt tokenization test."""
+    history = [("你好", "你好👋！我是人工智能助手 ChatGLM-6B。"),
+               ("介绍一下清华大学", "清华大学是中国著名的综合性大学。\n\n它位于  北京。")]
+    query = "它创建于哪一年"
+
+    def check_build_chat_inputs(self, model, tokenizer, num_rounds_list):
+        """compare the cached path with one-shot tokenization of the preprocessed joined prompt"""
+        for num_rounds in num_rounds_list:
+            prompt = tokenizer.preprocess_text(join_chat_prompt(self.query, self.history[:num_rounds]))
+            expected = tokenizer.build_inputs_with_special_tokens(tokenizer._tokenizer.encode(prompt))
+            inputs = model._build_chat_inputs(tokenizer, self.query, self.history[:num_rounds])
+            self.assertListEqual(expected, inputs["input_ids"].asnumpy()[0].tolist())
+
+    @pytest.mark.download
+    def test_build_chat_inputs(self):
+        """cached per-round tokenization must match tokenizing the joined prompt"""
+        model = get_tiny_model()
+        tokenizer = ChatGLMTokenizer.from_pretrained("chatglm-6b")
+        for num_rounds in [0, 1, 2, 1, 2]:
+            prompt = join_chat_prompt(self.query, self.history[:num_rounds])
+            inputs = model._build_chat_inputs(tokenizer, self.query, self.history[:num_rounds])
+            self.assertListEqual(tokenizer(prompt).tolist(), inputs["input_ids"].asnumpy()[0].tolist())
+
+    @pytest.mark.download
+    def test_build_chat_inputs_preprocess(self):
+        """lower casing and space removal apply to the cached rounds, which are not shared between tokenizers"""
+        model = get_tiny_model()
+        tokenizer = ChatGLMTokenizer.from_pretrained("chatglm-6b")
+        lower_tokenizer = ChatGLMTokenizer.from_pretrained("chatglm-6b")
+        lower_tokenizer.do_lower_case = True
+        space_tokenizer = ChatGLMTokenizer.from_pretrained("chatglm-6b")
+        space_tokenizer.remove_space = True
+        # interleaved on one model, every call must use the ids of its own tokenizer
+        for current in [tokenizer, lower_tokenizer, tokenizer, space_tokenizer, lower_tokenizer]:
+            self.check_build_chat_inputs(model, current, [2, 1, 2])
+
+
+def hf_top_k_top_p_filter(scores, top_k, top_p):
+    """reference top-k then top-p filter, sort and scatter back as in the HF logits warpers"""
+    scores = scores.copy()
+    if top_k > 0:
+        kth_largest = np.sort(scores, axis=-1)[:, -top_k][:, None]
+        scores[scores < kth_largest] = -np.inf
+    sorted_indices = np.argsort(scores, axis=-1)
+    sorted_scores = np.take_along_axis(scores, sorted_indices, axis=-1)
+    sorted_probs = np.exp(sorted_scores - sorted_scores.max(axis=-1, keepdims=True))
+    sorted_probs /= sorted_probs.sum(axis=-1, keepdims=True)
+    sorted_to_remove = np.cumsum(sorted_probs, axis=-1) <= 1 - top_p
+    sorted_to_remove[:, -1] = False
+    to_remove = np.zeros_like(sorted_to_remove)
+    np.put_along_axis(to_remove, sorted_indices, sorted_to_remove, axis=-1)
+    scores[to_remove] = -np.inf
+    return scores
+
+
+class ChatGLMSamplingTest(unittest.TestCase):
+    """ChatGLM sampling filter test."""
+    def test_top_k_top_p_filter(self):
+        """the sorted threshold filter must keep the same tokens as the sort/scatter filter"""
+        set_random_seed(42)
+        for top_k, top_p in [(0, 0.7), (0, 1.0), (10, 0.7), (50, 0.95), (1, 0.5), (0, 0.0), (10, -1.0)]:
+            scores = np.random.randn(4, 200).astype(np.float32) * 3
+            expected = hf_top_k_top_p_filter(scores, top_k, top_p)
+            filtered = top_k_top_p_filter(Tensor(scores), top_k, top_p).asnumpy()
+            np.testing.assert_array_equal(np.isinf(expected), np.isinf(filtered))
+            self.assertTrue(np.isfinite(filtered).any(axis=-1).all())
+
+
+class ChatGLMLogitsProcessorTest(unittest.TestCase):
+    """ChatGLM invalid score processor test."""
+    def test_invalid_score_processor(self):
+        """rows with nan/inf fall back to token 5, numpy scores stay numpy and Tensors stay Tensors"""
+        set_random_seed(42)
+        processor = InvalidScoreLogitsProcessor()
+        scores = np.random.randn(3, 16).astype(np.float32)
+        scores[1, 4] = np.nan
+        scores[2, 7] = np.inf
+        expected = scores.copy()
+        expected[1:] = 0
+        expected[1:, 5] = 5e4
+
+        outputs = processor(None, scores)
+        self.assertIsInstance(outputs, np.ndarray)
+        np.testing.assert_array_equal(expected, outputs)
+        outputs = processor(Tensor(np.zeros((3, 1), np.int64)), Tensor(scores))
+        self.assertIsInstance(outputs, Tensor)
+        np.testing.assert_array_equal(expected, outputs.asnumpy())
+
+    def test_greedy_generate_with_processor(self):
+        """the mixin greedy search passes numpy scores through the processor"""
+        set_random_seed(42)
+        model = get_tiny_model()
+        config = model.config
+        input_ids = np.array([[5, 6, 7, 8, config.gmask_token_id, config.bos_token_id]], np.int64)
+        expected = model.generate(input_ids, do_sample=False, max_length=12)
+        outputs = model.generate(input_ids, do_sample=False, max_length=12,
+                                 logits_processor=LogitsProcessorList([InvalidScoreLogitsProcessor()]))
+        np.testing.assert_array_equal(np.asarray(expected), np.asarray(outputs))
+
+
+class ChatGLMLoadTest(unittest.TestCase):
+    """ChatGLM stacked layernorm loading test."""
+    def test_load_extra_params(self):
+        """per layer layernorm params land in their rows of the stacked buffers and count as loaded"""
+        set_random_seed(42)
+        model = get_tiny_model()
+        hidden_size = model.config.hidden_size
+        input_gamma = np.random.randn(hidden_size).astype(np.float32)
+        post_attention_beta = np.random.randn(hidden_size).astype(np.float32)
+        final_gamma = np.random.randn(hidden_size).astype(np.float32)
+        param_dict = {
+            'transformer.layers.0.input_layernorm.gamma': mindspore.Parameter(Tensor(input_gamma), 'a'),
+            'transformer.layers.1.post_attention_layernorm.beta': mindspore.Parameter(Tensor(post_attention_beta), 'b'),
+            'transformer.final_layernorm.gamma': mindspore.Parameter(Tensor(final_gamma), 'c'),
+            'transformer.unknown.weight': mindspore.Parameter(Tensor(np.zeros(2, np.float32)), 'd'),
+        }
+        not_loaded = load_param_into_net(model, param_dict, model.base_model_prefix)
+        self.assertListEqual(['transformer.unknown.weight'], not_loaded)
+
+        gamma = model.transformer.layernorm_gamma.asnumpy().astype(np.float32)
+        beta = model.transformer.layernorm_beta.asnumpy().astype(np.float32)
+        # row 2 * i is layer i's input layernorm, row 2 * i + 1 its post attention layernorm
+        np.testing.assert_allclose(input_gamma, gamma[0], rtol=1e-3, atol=1e-3)
+        np.testing.assert_array_equal(np.ones((3, hidden_size)), gamma[1:])
+        np.testing.assert_allclose(post_attention_beta, beta[3], rtol=1e-3, atol=1e-3)
+        np.testing.assert_array_equal(np.zeros((3, hidden_size)), beta[:3])
+        np.testing.assert_allclose(final_gamma, model.transformer.final_layernorm.gamma.asnumpy(), rtol=1e-6)
+
+
+class ChatGLMCacheTest(unittest.TestCase):
+    """ChatGLM kv cache test."""
+    def check_decode_matches_prefill(self, kv_int8, atol):
+        """prefill of a prompt then decode steps must give the logits of prefilling the whole sequence"""
+        set_random_seed(42)
+        model = get_tiny_model(max_batch_size=2, kv_int8=kv_int8)
+        config = model.config
+        input_ids = np.array([[5, 6, 7, 8, config.gmask_token_id, config.bos_token_id, 11, 12, 13, 14],
+                              [21, 22, config.mask_token_id, 24, 25, config.bos_token_id, 31, 32, 33, 34]], np.int64)
+        prompt_length, per_bucket_size = 6, 4
+        # prefill references first, each of them rewrites the cache from slot 0
+        expected = []
+        for seq_length in range(prompt_length + 1, input_ids.shape[1] + 1):
+            inputs = model.prepare_inputs_prefill(input_ids[:, :seq_length], bucket_size=per_bucket_size)
+            expected.append(model(*inputs)[0][:, -1].asnumpy().astype(np.float32))
+
+        model(*model.prepare_inputs_prefill(input_ids[:, :prompt_length], bucket_size=per_bucket_size))
+        for step, seq_length in enumerate(range(prompt_length + 1, input_ids.shape[1] + 1)):
+            # the new token is written to the slot at start_pos, the steps cross the 8 -> 16 bucket boundary
+            inputs = model.prepare_inputs_decode(input_ids[:, :seq_length], start_pos=seq_length - 1,
+                                                 bucket_size=per_bucket_size)
+            outputs = model(*inputs)[0][:, -1].asnumpy().astype(np.float32)
+            np.testing.assert_allclose(expected[step], outputs, rtol=1e-2, atol=atol)
+
+    def test_decode_matches_prefill(self):
+        """decode steps read back exactly what prefill wrote to the cache"""
+        self.check_decode_matches_prefill(kv_int8=False, atol=1e-2)
+
+    def test_decode_matches_prefill_kv_int8(self):
+        """decode steps over the int8 cache stay within the quantization error"""
+        self.check_decode_matches_prefill(kv_int8=True, atol=1e-1)
+
+    def test_reorder_cache(self):
+        """beam reordering permutes the batch rows of the cache Parameter in place"""
+        model = get_tiny_model(max_batch_size=3)
+        past = model.transformer.get_past_key_values()
+        values = np.random.randn(*past.shape).astype(np.float16)
+        past.set_data(Tensor(values))
+        # two beams swapped, the cache row past the beams keeps its place
+        reordered = model._reorder_cache(past, Tensor(np.array([1, 0], np.int32)))
+        expected = values[:, :, [1, 0, 2]]
+        np.testing.assert_array_equal(expected, reordered.asnumpy())
+        np.testing.assert_array_equal(expected, model.transformer.get_past_key_values().asnumpy())
+
+
 class ChatGLMGenerationTest(unittest.TestCase):
     """ChatGLM generation test."""
     @pytest.mark.skipif(True, reason="not ready")